@@ -1,7 +1,13 @@
 # manager_and_bot.py
 import asyncio
 import os
+import re
+import atexit
+import functools
+import queue
 import logging
+import logging.handlers
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 from telegram import Update
@@ -10,7 +16,7 @@ from telegram.ext import (
     filters, ContextTypes, ConversationHandler
 )
 
-from user_media_saver import run_user_instance # Your Telethon script
+from user_media_saver import run_user_instance, monitoring_tasks, log_crypto_backend, DOWNLOAD_PATH_BASE # Your Telethon script
 from telethon import errors as telethon_errors # For specific error handling
 
 # Load environment variables from .env file
@@ -21,17 +27,30 @@ APP_API_HASH = os.getenv('API_HASH')
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 HANDLER_COMMAND = os.getenv('HANDLER_COMMAND', '.d')
 USER_IDS_FILE = "logged_in_user_ids.txt" # File to store user IDs
+PUBLIC_URL = os.getenv('PUBLIC_URL') # e.g. https://bot.example.com; enables webhook mode when set
+WEBHOOK_PORT = int(os.getenv('PORT') or 8443) # An empty PORT= falls back to the default too
 
 # Configure logging
+# Handlers only enqueue records; a background listener thread does the actual file/console writes
+_log_queue = queue.Queue(-1)
+_log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+_file_handler = logging.FileHandler("bot_activity.log") # Log to a file
+_file_handler.setFormatter(_log_formatter)
+_stream_handler = logging.StreamHandler()                # Log to console
+_stream_handler.setFormatter(_log_formatter)
+_log_listener = logging.handlers.QueueListener(_log_queue, _file_handler, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s")) # Message only; the listener's handlers add the prefix
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot_activity.log"), # Log to a file
-        logging.StreamHandler()                  # Log to console
-    ]
+    handlers=[_queue_handler]
 )
 logger = logging.getLogger(__name__)
+# Telethon logs every request/chunk at INFO; only surface its warnings and errors
+logging.getLogger('telethon').setLevel(logging.WARNING)
 
 # --- Environment Variable Checks ---
 if not BOT_TOKEN:
@@ -47,64 +66,128 @@ except ValueError:
     exit()
 
 
+# --- Input Validation ---
+PHONE_RE = re.compile(r'^\+\d{7,15}$') # International format, e.g. +12345678900
+
 # --- Conversation States for Login ---
 AWAIT_PHONE, AWAIT_CODE, AWAIT_PASSWORD = range(3) # Renamed for clarity
 
+# --- Per-conversation login state ---
+@dataclass(slots=True)
+class LoginState:
+    """Everything a single login conversation needs, stored as context.user_data['_login']."""
+    phone: str
+    code_q: asyncio.Queue     # maxsize=1; carries the login code (or None on cancel)
+    password_q: asyncio.Queue # maxsize=1; carries the 2FA password (or None on cancel)
+    code_sent: asyncio.Event
+    task: asyncio.Task | None = None
+
 # --- Store for active user Telethon tasks ---
 # Key: bot_user_id (from Update), Value: asyncio.Task (the task running run_user_instance)
 active_user_telethon_tasks = {}
 
+def _drop_task(bot_user_id: int, task: asyncio.Task) -> None:
+    """Done-callback: forget a run_user_instance task unless it ended in a successful login."""
+    if active_user_telethon_tasks.get(bot_user_id) is not task:
+        return # Already removed, or replaced by a newer login attempt
+    if not task.cancelled() and task.exception() is None and isinstance(task.result(), int):
+        return # Logged in; keep the entry so /logout can find it
+    active_user_telethon_tasks.pop(bot_user_id, None)
+    logger.info(f"Dropped finished Telethon task for user {bot_user_id} (login did not complete).")
+
+# --- Task group owning every logged-in client's monitoring task ---
+# Lives for the lifetime of the Application (see _post_init / _post_shutdown)
+MONITOR_GROUP_KEY = 'monitor_group'
+
+async def _run_monitor_group(application: Application, ready: asyncio.Event) -> None:
+    async with asyncio.TaskGroup() as task_group:
+        application.bot_data[MONITOR_GROUP_KEY] = task_group
+        ready.set()
+        await asyncio.Event().wait() # Park until cancelled at shutdown; that cancels every monitor
+
+async def _post_init(application: Application) -> None:
+    ready = asyncio.Event()
+    application.bot_data['monitor_group_runner'] = asyncio.create_task(_run_monitor_group(application, ready))
+    await ready.wait()
+
+async def _post_shutdown(application: Application) -> None:
+    runner = application.bot_data.pop('monitor_group_runner', None)
+    if runner:
+        runner.cancel()
+        try:
+            await runner
+        except asyncio.CancelledError:
+            pass
+    logger.info("All monitoring tasks stopped.")
+
+# Strong references to fire-and-forget helper tasks so they aren't garbage-collected mid-run
+_background_tasks: set[asyncio.Task] = set()
+
+# --- Cached listing of the sessions directory ---
+# Populated once in main() and kept in sync on login/logout, so logout needs no stat() call
+SESSIONS_DIR = 'sessions'
+_session_files: set[str] = set()
+
 # --- Function to manage user IDs file ---
+# In-memory mirror of USER_IDS_FILE, loaded once so new IDs can simply be appended
+_known_user_ids: set[int] = set()
+if os.path.exists(USER_IDS_FILE):
+    with open(USER_IDS_FILE, 'r') as f:
+        _id_tokens = f.read().split()
+    try:
+        _known_user_ids = set(map(int, _id_tokens))
+    except ValueError: # Stray non-numeric entry; skip it rather than lose the whole set
+        _known_user_ids = {int(tok) for tok in _id_tokens if tok.isdigit()}
+
+def _sync_store(uid: int) -> None:
+    """Blocking append of a single user ID; run via asyncio.to_thread."""
+    with open(USER_IDS_FILE, 'a') as f:
+        f.write(f"{uid}\n")
+
 async def add_user_id_to_store(user_id_to_add: int):
-    """Adds a user ID to the storage file, ensuring no duplicates."""
-    user_id_to_add_str = str(user_id_to_add) # Store as string
+    """Appends a user ID to the storage file, ensuring no duplicates."""
+    uid = int(user_id_to_add)
+    if uid in _known_user_ids:
+        return
+    _known_user_ids.add(uid) # Claim it before awaiting so concurrent logins don't double-append
     try:
-        existing_ids = set()
-        if os.path.exists(USER_IDS_FILE):
-            with open(USER_IDS_FILE, 'r') as f:
-                for line in f:
-                    existing_ids.add(line.strip())
-        
-        if user_id_to_add_str not in existing_ids:
-            # Add and resort numerically for cleaner file
-            numeric_ids = {int(id_str) for id_str in existing_ids if id_str.isdigit()}
-            numeric_ids.add(int(user_id_to_add_str))
-            
-            with open(USER_IDS_FILE, 'w') as f:
-                for uid_val in sorted(list(numeric_ids)):
-                    f.write(str(uid_val) + '\n')
-            logger.info(f"User ID {user_id_to_add_str} (Telethon Account) added to {USER_IDS_FILE}.")
-        # else:
-            # logger.info(f"User ID {user_id_to_add_str} already exists in {USER_IDS_FILE}.")
+        await asyncio.to_thread(_sync_store, uid)
+        logger.info(f"User ID {uid} (Telethon Account) added to {USER_IDS_FILE}.")
     except IOError as e:
+        _known_user_ids.discard(uid)
         logger.error(f"IOError while updating {USER_IDS_FILE}: {e}")
     except Exception as e:
+        _known_user_ids.discard(uid)
         logger.error(f"Unexpected error while updating {USER_IDS_FILE}: {e}", exc_info=True)
 
+# --- Static reply texts (HANDLER_COMMAND is fixed at import time) ---
+_START_SUFFIX = (
+    f"\nWelcome! I can help you save media to your 'Saved Messages'."
+    f"\n➡️ Use /login to start the setup process."
+    f"\n\nℹ️ Once logged in, reply with '<b>{HANDLER_COMMAND}</b>' to any message with media to save it."
+    f"\n\n➡️ Use /logout to stop the service for your account."
+    f"\n➡️ Use /help for more info."
+)
+
+_HELP_TEXT = (
+    f"❓ How to use:\n"
+    f"1. Type /login to begin authorizing the bot with your Telegram account.\n"
+    f"2. I will ask for your phone number (international format, e.g., +12345678900).\n"
+    f"3. Then, I'll ask for the login code Telegram sends to your account.\n"
+    f"4. If you have Two-Factor Authentication (2FA) enabled, I'll ask for your 2FA password.\n"
+    f"5. Once logged in, go to any chat. Reply directly to a message containing media using just the command: {HANDLER_COMMAND}\n"
+    f"6. The media will be downloaded by the service and sent to your 'Saved Messages' chat.\n"
+    f"7. Use /logout to stop the service. This will also delete your session file from my server."
+)
+
 # --- Bot Command Handlers ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     logger.info(f"User {user.id} ({user.username}) started chat with bot.")
-    await update.message.reply_html(
-        rf"Hi {user.mention_html()}!",
-        f"\nWelcome! I can help you save media to your 'Saved Messages'."
-        f"\n➡️ Use /login to start the setup process."
-        f"\n\nℹ️ Once logged in, reply with '<b>{HANDLER_COMMAND}</b>' to any message with media to save it."
-        f"\n\n➡️ Use /logout to stop the service for your account."
-        f"\n➡️ Use /help for more info."
-    )
+    await update.message.reply_html(rf"Hi {user.mention_html()}!" + _START_SUFFIX)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await update.message.reply_text(
-        f"❓ How to use:\n"
-        f"1. Type /login to begin authorizing the bot with your Telegram account.\n"
-        f"2. I will ask for your phone number (international format, e.g., +12345678900).\n"
-        f"3. Then, I'll ask for the login code Telegram sends to your account.\n"
-        f"4. If you have Two-Factor Authentication (2FA) enabled, I'll ask for your 2FA password.\n"
-        f"5. Once logged in, go to any chat. Reply directly to a message containing media using just the command: {HANDLER_COMMAND}\n"
-        f"6. The media will be downloaded by the service and sent to your 'Saved Messages' chat.\n"
-        f"7. Use /logout to stop the service. This will also delete your session file from my server."
-    )
+    await update.message.reply_text(_HELP_TEXT)
 
 # --- Login Conversation Functions ---
 async def login_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -114,7 +197,8 @@ async def login_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         await update.message.reply_text("Sorry, the bot is not configured correctly by the administrator (API details missing). Login is currently unavailable.")
         return ConversationHandler.END
 
-    if user_id in active_user_telethon_tasks and not active_user_telethon_tasks[user_id].done():
+    existing_task = active_user_telethon_tasks.get(user_id)
+    if existing_task is not None and not existing_task.done():
         # Check if task is truly running or if it's an old entry for a failed task
         # This part could be more robust, e.g. by checking task's exception status
         await update.message.reply_text("You seem to have an active session. Use /logout first if you want to start a new one.")
@@ -129,21 +213,25 @@ async def received_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     bot_user_id = update.effective_user.id
     phone = update.message.text.strip()
 
-    if not (phone.startswith('+') and phone[1:].isdigit() and len(phone) > 7): # Basic validation
+    if not PHONE_RE.match(phone): # Basic validation
         await update.message.reply_text("That doesn't look like a valid phone number. Please try again (e.g., +12345678900) or type /cancel.")
         return AWAIT_PHONE # Stay in the same state
 
-    context.user_data['phone_to_login'] = phone
-    context.user_data['code_future'] = asyncio.Future()
-    context.user_data['password_future'] = asyncio.Future()
-    
+    state = LoginState(
+        phone=phone,
+        code_q=asyncio.Queue(maxsize=1),
+        password_q=asyncio.Queue(maxsize=1),
+        code_sent=asyncio.Event()
+    )
+    context.user_data['_login'] = state
+
     session_name = f"user_{bot_user_id}" # Session file name, unique to the bot user ID
 
     # Define the callbacks that Telethon's run_user_instance will use
     async def get_code_from_bot_callback() -> str | None:
-        logger.info(f"Telethon (bot_user_id {bot_user_id}, phone {phone}) is now awaiting code_future.")
+        logger.info(f"Telethon (bot_user_id {bot_user_id}, phone {phone}) is now awaiting the login code.")
         try:
-            code = await asyncio.wait_for(context.user_data['code_future'], timeout=300.0) # 5 min timeout
+            code = await asyncio.wait_for(state.code_q.get(), timeout=300.0) # 5 min timeout
             return code
         except asyncio.TimeoutError:
             logger.warning(f"User {bot_user_id} (phone {phone}) timed out providing code to bot.")
@@ -151,31 +239,43 @@ async def received_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return None 
 
     async def get_password_from_bot_callback() -> str | None:
-        logger.info(f"Telethon (bot_user_id {bot_user_id}, phone {phone}) is now awaiting password_future.")
+        logger.info(f"Telethon (bot_user_id {bot_user_id}, phone {phone}) is now awaiting the 2FA password.")
         try:
-            password = await asyncio.wait_for(context.user_data['password_future'], timeout=300.0)
+            password = await asyncio.wait_for(state.password_q.get(), timeout=300.0)
             return password
         except asyncio.TimeoutError:
             logger.warning(f"User {bot_user_id} (phone {phone}) timed out providing 2FA password to bot.")
             return None
 
-    await update.message.reply_text(f"Thank you. Attempting to log in with {phone}.\n"
-                                     "A code will be sent to your Telegram account. Please send that code back to me when I ask for it.")
-
     # Start the Telethon login task in the background
     telethon_task = asyncio.create_task(
         run_user_instance(
             session_name, APP_API_ID, APP_API_HASH, HANDLER_COMMAND,
-            phone, get_code_from_bot_callback, get_password_from_bot_callback
+            phone, get_code_from_bot_callback, get_password_from_bot_callback,
+            task_group=context.application.bot_data[MONITOR_GROUP_KEY],
+            code_sent_event=state.code_sent
         )
     )
     # Store this task; it will return the Telethon user ID or None/raise error
     active_user_telethon_tasks[bot_user_id] = telethon_task
-    context.user_data['current_login_task'] = telethon_task 
-
-    # After a brief moment (for Telethon's send_code_request to likely execute), ask user for code.
-    await asyncio.sleep(1.5) # Small delay, adjust if needed
-    await update.message.reply_text("Please send me the login code you received from Telegram (it's usually a 5 or 6 digit number).")
+    telethon_task.add_done_callback(functools.partial(_drop_task, bot_user_id))
+    # Telethon creates the database when the client is built; WAL mode adds the -wal/-shm journals
+    _session_files.update(f"{session_name}.session{suffix}" for suffix in ('', '-wal', '-shm'))
+    state.task = telethon_task
+
+    # Wait until Telethon has actually requested the code before asking the user for it. The task may
+    # also finish first: the code request failed, or the stored session was already authorized.
+    code_sent_wait = asyncio.create_task(state.code_sent.wait())
+    done, _ = await asyncio.wait({code_sent_wait, telethon_task}, timeout=10.0, return_when=asyncio.FIRST_COMPLETED)
+    if not code_sent_wait.done():
+        code_sent_wait.cancel()
+    if telethon_task in done and not state.code_sent.is_set():
+        return await _finish_login(update, context, telethon_task, bot_user_id, phone)
+    if not done:
+        logger.warning(f"User {bot_user_id} (phone {phone}): code request not confirmed within timeout, prompting anyway.")
+    await update.message.reply_text(f"Thank you. Attempting to log in with {phone}.\n"
+                                     "A code will be sent to your Telegram account.\n"
+                                     "Please send me the login code when you receive it (it's usually a 5 or 6 digit number).")
     return AWAIT_CODE
 
 
@@ -183,85 +283,90 @@ async def received_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     """Handles receiving the login code."""
     bot_user_id = update.effective_user.id
     code = update.message.text.strip()
-    phone = context.user_data.get('phone_to_login', 'N/A')
-
+    state: LoginState | None = context.user_data.get('_login')
+    phone = state.phone if state else 'N/A'
 
-    if 'code_future' in context.user_data and not context.user_data['code_future'].done():
+    if state and state.code_q.empty():
         logger.info(f"Bot user {bot_user_id} (phone {phone}) submitted code: {code[:2]}***")
-        context.user_data['code_future'].set_result(code) # Unblock Telethon task
-        await update.message.reply_text("Got it! Processing code...")
-        
+        state.code_q.put_nowait(code) # Unblock Telethon task
         # The Telethon task will now proceed. It might finish login, or it might need 2FA.
         # If 2FA is needed, run_user_instance will call get_password_from_bot_callback.
-        # That callback awaits password_future, so we transition the conversation to AWAIT_PASSWORD.
-        await update.message.reply_text("If Two-Factor Authentication (2FA) is enabled for your account, please send your 2FA password now. Otherwise, the login will complete if the code was correct.")
+        # That callback awaits password_q, so we transition the conversation to AWAIT_PASSWORD.
+        await update.message.reply_text("Got it! Processing code...\n"
+                                        "If Two-Factor Authentication (2FA) is enabled for your account, please send your 2FA password now. Otherwise, the login will complete if the code was correct.")
         return AWAIT_PASSWORD
     else:
-        logger.warning(f"User {bot_user_id} (phone {phone}) sent code, but code_future was not ready or already done.")
+        logger.warning(f"User {bot_user_id} (phone {phone}) sent code, but no code was expected or one is already pending.")
         await update.message.reply_text("Something went wrong, or the code was already processed. If login fails, please try /cancel and then /login again.")
         # Don't end conversation here, let received_password handle the next step or failure.
         # Or, could try to re-check task status. For simplicity, proceed to AWAIT_PASSWORD.
         return AWAIT_PASSWORD
 
+async def _finish_login(update: Update, context: ContextTypes.DEFAULT_TYPE, login_task: asyncio.Task, bot_user_id: int, phone: str) -> int:
+    """Awaits the run_user_instance task, tells the user how the login went and ends the conversation."""
+    try:
+        # Wait for the run_user_instance task to return.
+        # It returns Telethon me.id on success, None on failure, or raises specific login errors.
+        # Give it a reasonable time to complete the sign_in process.
+        logged_in_telethon_user_id = await asyncio.wait_for(login_task, timeout=30.0) # Increased timeout
+
+        if isinstance(logged_in_telethon_user_id, int): # Success!
+            await add_user_id_to_store(logged_in_telethon_user_id) # Store the Telethon account ID
+            await update.message.reply_text(
+                f"✅ Login successful! (Telegram Account ID: {logged_in_telethon_user_id})\n"
+                f"I am now monitoring your outgoing replies for '<b>{HANDLER_COMMAND}</b>'.",
+                parse_mode='HTML'
+            )
+            # The task in active_user_telethon_tasks[bot_user_id] is the one for run_user_instance.
+            # run_user_instance itself spawns the run_until_disconnected task.
+            # For logout, we cancel the main run_user_instance task.
+        elif logged_in_telethon_user_id is None: # Explicit failure from run_user_instance
+            await update.message.reply_text("❌ Login failed. The details might have been incorrect. Please try /login again or /cancel.")
+        else: # Should not happen if return type is int | None
+            await update.message.reply_text("❓ Login status unclear. Please try /login again or /cancel.")
+
+    except asyncio.TimeoutError:
+        logger.error(f"Login task for user {bot_user_id} (phone {phone}) timed out.")
+        await update.message.reply_text("❌ Login process timed out. Please try /login again or /cancel.")
+    except (telethon_errors.PhoneCodeInvalidError, telethon_errors.PhoneNumberInvalidError, telethon_errors.PasswordHashInvalidError) as specific_telethon_error:
+        error_message = str(specific_telethon_error)
+        if isinstance(specific_telethon_error, telethon_errors.PasswordHashInvalidError):
+            error_message = "The 2FA password you entered was incorrect."
+        elif isinstance(specific_telethon_error, telethon_errors.PhoneCodeInvalidError):
+            error_message = "The login code you entered was incorrect."
+
+        await update.message.reply_text(f"❌ Login failed: {error_message}. Please try /login again or /cancel.")
+    except telethon_errors.FloodWaitError as e:
+        logger.warning(f"Login for user {bot_user_id} (phone {phone}) hit a flood wait of {e.seconds}s.")
+        await update.message.reply_text(f"❌ Telegram is rate-limiting login attempts. Please wait {e.seconds} seconds and try /login again.")
+    except OSError as e: # Includes ConnectionError
+        logger.error(f"Connection error during final login step for user {bot_user_id} (phone {phone}): {e}")
+        await update.message.reply_text("❌ Could not reach Telegram to finish logging in. Please try /login again later.")
+    except Exception as e: # Catch other exceptions from awaiting login_task
+        logger.error(f"Error during final login step for user {bot_user_id} (phone {phone}): {e}", exc_info=True)
+        await update.message.reply_text(f"❌ An unexpected error occurred during login: {e}. Please try /login again or /cancel.")
+    finally:
+        context.user_data.clear() # Clean up user_data for this conversation
+        return ConversationHandler.END # End conversation
+
 async def received_password(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles receiving the 2FA password."""
     bot_user_id = update.effective_user.id
     password = update.message.text.strip() # Don't log password
-    phone = context.user_data.get('phone_to_login', 'N/A')
+    state: LoginState | None = context.user_data.get('_login')
+    phone = state.phone if state else 'N/A'
     logger.info(f"Bot user {bot_user_id} (phone {phone}) submitted 2FA password.")
 
-    # Fulfill the password_future if it's waiting
-    if 'password_future' in context.user_data and not context.user_data['password_future'].done():
-        context.user_data['password_future'].set_result(password)
+    # Hand the password over if one isn't already pending
+    if state and state.password_q.empty():
+        state.password_q.put_nowait(password)
         await update.message.reply_text("Password received. Finalizing login, please wait...")
     # else: This state might be reached if no 2FA was needed and login succeeded/failed after code.
 
     # Now, await the result of the Telethon login task.
-    login_task = context.user_data.get('current_login_task')
+    login_task = state.task if state else None
     if login_task:
-        try:
-            # Wait for the run_user_instance task to return.
-            # It returns Telethon me.id on success, None on failure, or raises specific login errors.
-            # Give it a reasonable time to complete the sign_in process after password.
-            logged_in_telethon_user_id = await asyncio.wait_for(login_task, timeout=30.0) # Increased timeout
-
-            if isinstance(logged_in_telethon_user_id, int): # Success!
-                await add_user_id_to_store(logged_in_telethon_user_id) # Store the Telethon account ID
-                await update.message.reply_text(
-                    f"✅ Login successful! (Telegram Account ID: {logged_in_telethon_user_id})\n"
-                    f"I am now monitoring your outgoing replies for '<b>{HANDLER_COMMAND}</b>'.",
-                    parse_mode='HTML'
-                )
-                # The task in active_user_telethon_tasks[bot_user_id] is the one for run_user_instance.
-                # run_user_instance itself spawns the run_until_disconnected task.
-                # For logout, we cancel the main run_user_instance task.
-            elif logged_in_telethon_user_id is None: # Explicit failure from run_user_instance
-                await update.message.reply_text("❌ Login failed. The details might have been incorrect. Please try /login again or /cancel.")
-                active_user_telethon_tasks.pop(bot_user_id, None) # Remove failed task entry
-            else: # Should not happen if return type is int | None
-                await update.message.reply_text("❓ Login status unclear. Please try /login again or /cancel.")
-                active_user_telethon_tasks.pop(bot_user_id, None)
-
-        except asyncio.TimeoutError:
-            logger.error(f"Login task for user {bot_user_id} (phone {phone}) timed out after password submission.")
-            await update.message.reply_text("❌ Login process timed out. Please try /login again or /cancel.")
-            active_user_telethon_tasks.pop(bot_user_id, None)
-        except (telethon_errors.PhoneCodeInvalidError, telethon_errors.PhoneNumberInvalidError, telethon_errors.PasswordHashInvalidError) as specific_telethon_error:
-            error_message = str(specific_telethon_error)
-            if isinstance(specific_telethon_error, telethon_errors.PasswordHashInvalidError):
-                error_message = "The 2FA password you entered was incorrect."
-            elif isinstance(specific_telethon_error, telethon_errors.PhoneCodeInvalidError):
-                error_message = "The login code you entered was incorrect."
-
-            await update.message.reply_text(f"❌ Login failed: {error_message}. Please try /login again or /cancel.")
-            active_user_telethon_tasks.pop(bot_user_id, None)
-        except Exception as e: # Catch other exceptions from awaiting login_task
-            logger.error(f"Error during final login step for user {bot_user_id} (phone {phone}): {e}", exc_info=True)
-            await update.message.reply_text(f"❌ An unexpected error occurred during login: {e}. Please try /login again or /cancel.")
-            active_user_telethon_tasks.pop(bot_user_id, None)
-        finally:
-            context.user_data.clear() # Clean up user_data for this conversation
-            return ConversationHandler.END # End conversation
+        return await _finish_login(update, context, login_task, bot_user_id, phone)
     else:
         logger.warning(f"User {bot_user_id} (phone {phone}) sent password, but login_task not found in context.")
         await update.message.reply_text("Error: Could not find the login task. Please try /login again or /cancel.")
@@ -271,15 +376,17 @@ async def received_password(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def cancel_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Cancels the ongoing login conversation."""
     bot_user_id = update.effective_user.id
-    phone = context.user_data.get('phone_to_login', 'N/A')
+    state: LoginState | None = context.user_data.get('_login')
+    phone = state.phone if state else 'N/A'
     logger.info(f"User {bot_user_id} (phone {phone}) cancelled login process.")
     await update.message.reply_text("Login process cancelled.")
     
-    # Signal futures to unblock Telethon task if it's waiting, allowing it to terminate cleanly
-    if context.user_data.get('code_future') and not context.user_data['code_future'].done():
-        context.user_data['code_future'].set_result(None)
-    if context.user_data.get('password_future') and not context.user_data['password_future'].done():
-        context.user_data['password_future'].set_result(None)
+    # Push None to unblock the Telethon task if it's waiting, allowing it to terminate cleanly
+    if state:
+        if state.code_q.empty():
+            state.code_q.put_nowait(None)
+        if state.password_q.empty():
+            state.password_q.put_nowait(None)
 
     # Cancel the main Telethon task associated with this user's login attempt
     task = active_user_telethon_tasks.pop(bot_user_id, None)
@@ -290,37 +397,72 @@ async def cancel_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     context.user_data.clear() # Clear any stored data for this user's conversation
     return ConversationHandler.END
 
+async def _await_cancel(task: asyncio.Task, bot_user_id: int) -> None:
+    """Waits (briefly) for a cancelled Telethon task to finish, logging the outcome."""
+    try:
+        await asyncio.wait_for(task, timeout=5.0)
+    except asyncio.CancelledError:
+        logger.info(f"Telethon task for user {bot_user_id} was cancelled successfully.")
+    except asyncio.TimeoutError:
+        logger.warning(f"Telethon task for user {bot_user_id} did not fully cancel within timeout on logout.")
+    except Exception as e: # Other exceptions during task cleanup
+        logger.error(f"Exception while waiting for Telethon task cancellation for user {bot_user_id}: {e}")
+
+async def _remove_session_files(bot_user_id: int, monitor: asyncio.Task | None) -> None:
+    """Waits (briefly) for the user's client to stop, then deletes its session database and WAL journals."""
+    if monitor:
+        # Let the client disconnect and close its session database before the files are removed
+        # (Windows refuses to delete files that are still open)
+        _, still_running = await asyncio.wait({monitor}, timeout=5.0)
+        if still_running:
+            logger.warning(f"Monitoring task for user {bot_user_id} did not stop within timeout on logout.")
+
+    session_file_name = f"user_{bot_user_id}.session"
+    session_file = os.path.join(SESSIONS_DIR, session_file_name)
+    try:
+        await asyncio.to_thread(os.remove, session_file)
+        _session_files.discard(session_file_name)
+        # WAL-mode sessions may leave journal files alongside the database
+        for journal_name in (f"{session_file_name}-wal", f"{session_file_name}-shm"):
+            if journal_name in _session_files:
+                _session_files.discard(journal_name)
+                try: await asyncio.to_thread(os.remove, os.path.join(SESSIONS_DIR, journal_name))
+                except OSError: pass
+        logger.info(f"Session file {session_file} for user {bot_user_id} removed.")
+    except OSError as e:
+        logger.error(f"Failed to remove session file {session_file} for user {bot_user_id}: {e}")
+
 async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Logs out the user by stopping their Telethon task and deleting the session file."""
     bot_user_id = update.effective_user.id
     logger.info(f"User {bot_user_id} initiated logout.")
     task = active_user_telethon_tasks.pop(bot_user_id, None) # Remove task from active dict
-    
+
+    # Stop the running client (if logged in) so it no longer watches for the trigger
+    monitor = monitoring_tasks.get(f"user_{bot_user_id}")
+    if monitor and not monitor.done():
+        monitor.cancel()
+        logger.info(f"Cancelled monitoring task for user {bot_user_id} upon logout.")
+    else:
+        monitor = None
+
     if task:
         if not task.done():
             task.cancel() # Cancel the asyncio.Task that runs run_user_instance
             logger.info(f"Attempting to cancel Telethon task for user {bot_user_id} upon logout.")
-            try:
-                # Optionally wait for task to acknowledge cancellation, but don't block too long
-                await asyncio.wait_for(task, timeout=5.0) 
-            except asyncio.CancelledError:
-                logger.info(f"Telethon task for user {bot_user_id} was cancelled successfully.")
-            except asyncio.TimeoutError:
-                logger.warning(f"Telethon task for user {bot_user_id} did not fully cancel within timeout on logout.")
-            except Exception as e: # Other exceptions during task cleanup
-                logger.error(f"Exception while waiting for Telethon task cancellation for user {bot_user_id}: {e}")
+            # Wait for the cancellation in the background so the reply isn't held up
+            cleanup_task = asyncio.create_task(_await_cancel(task, bot_user_id))
+            _background_tasks.add(cleanup_task)
+            cleanup_task.add_done_callback(_background_tasks.discard)
         else: # Task was already done (e.g. failed previously)
             logger.info(f"Telethon task for user {bot_user_id} was already done before logout.")
 
-        session_file = os.path.join('sessions', f"user_{bot_user_id}.session")
-        if os.path.exists(session_file):
-            try:
-                os.remove(session_file)
-                await update.message.reply_text("✅ You have been logged out. Your session file has been removed.")
-                logger.info(f"Session file {session_file} for user {bot_user_id} removed.")
-            except OSError as e:
-                await update.message.reply_text("⚠️ Logged out, but failed to remove session file. Please contact admin.")
-                logger.error(f"Failed to remove session file {session_file} for user {bot_user_id}: {e}")
+        if f"user_{bot_user_id}.session" in _session_files:
+            # The client may still be shutting down; remove its files once it has, without holding up the reply
+            removal_task = asyncio.create_task(_remove_session_files(bot_user_id, monitor))
+            _background_tasks.add(removal_task)
+            removal_task.add_done_callback(_background_tasks.discard)
+            await update.message.reply_text("✅ You have been logged out. Your session file is being removed.")
         else:
             await update.message.reply_text("✅ You have been logged out (no session file found to remove).")
     else:
@@ -328,11 +470,28 @@ async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 def main() -> None:
     """Starts the bot."""
+    log_crypto_backend()
+    # Use the libuv-based event loop when available; falls back to the default asyncio loop
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Using uvloop event loop.")
+    except ImportError:
+        logger.info("uvloop not installed, using default asyncio event loop.")
+
     # Ensure essential directories exist at startup
-    if not os.path.exists('sessions'): os.makedirs('sessions')
-    if not os.path.exists(DOWNLOAD_PATH_BASE): os.makedirs(DOWNLOAD_PATH_BASE)
+    os.makedirs(SESSIONS_DIR, exist_ok=True)
+    os.makedirs(DOWNLOAD_PATH_BASE, exist_ok=True)
+
+    _session_files.update(os.listdir(SESSIONS_DIR))
 
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     # Login Conversation Handler
     conv_handler = ConversationHandler(
@@ -353,8 +512,19 @@ def main() -> None:
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("logout", logout_command))
 
-    logger.info("Bot starting and ready to poll for updates...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if PUBLIC_URL:
+        # Webhook mode: Telegram pushes updates to us, no long-poll round-trips
+        logger.info(f"Bot starting in webhook mode on port {WEBHOOK_PORT}...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        logger.info("PUBLIC_URL not set. Bot starting and ready to poll for updates...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,13 +1,466 @@
 # user_media_saver.py
 import asyncio
+import io
+import functools
 import os
+import math
+import re
+import sqlite3
+import tempfile
 import logging
+import aiofiles
 from datetime import datetime as dt # Not strictly used in current save logic but good for potential future use
-from telethon import TelegramClient, events, errors
-from telethon.sessions import StringSession # Not used for file session but good to have if switching
+from telethon import TelegramClient, events, errors, functions, types
+from telethon.sessions import StringSession, SQLiteSession # StringSession not used for file session but good to have if switching
 
 logger = logging.getLogger(__name__) # Get logger named after the module
+
+# cryptg gives Telethon a native AES-IGE implementation; without it every block is decrypted in pure Python
+try:
+    import cryptg # noqa: F401
+    HAS_CRYPTG = True
+except ImportError:
+    HAS_CRYPTG = False
+
+
+def log_crypto_backend() -> None:
+    """Reports whether cryptg is in use. Called by the manager once logging is configured."""
+    if HAS_CRYPTG:
+        logger.info("cryptg available: Telethon will use native AES-IGE for media transfers.")
+    else:
+        logger.warning("cryptg is not installed; media transfers will use slow pure-Python crypto. Install it with 'pip install cryptg'.")
+
+
 DOWNLOAD_PATH_BASE = "user_downloads/"
+# Ensure necessary directories exist (once, at import, instead of on every run_user_instance call)
+os.makedirs('sessions', exist_ok=True)
+os.makedirs(DOWNLOAD_PATH_BASE, exist_ok=True)
+_dirs_created: set[int] = set() # Telethon user IDs whose download directory already exists
+
+# Strong references to pending status-message cleanups so they aren't garbage-collected mid-sleep
+_cleanup_tasks: set[asyncio.Task] = set()
+
+# Key: session_name, Value: the task running that client's run_until_disconnected()
+monitoring_tasks: dict[str, asyncio.Task] = {}
+
+IN_MEMORY_MAX_SIZE = 50 * 1024 * 1024 # Media up to this size is downloaded into memory; larger documents use parallel_download
+
+QUICK_SAVE_MAX_SIZE = 5 * 1024 * 1024 # Media up to this size gets no status message, only a reaction on success
+SUCCESS_REACTION = '👍'
+
+# Shared by every user instance in this process, so simultaneous saves can't stampede Telegram
+_download_sem = asyncio.Semaphore(8)
+
+# Retry policy for downloads/uploads (see _with_retry)
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0 # Seconds; doubled on every attempt for transient errors
+MAX_FLOOD_WAIT_RETRY = 60 # Longer flood waits are reported to the user instead of retried
+TRANSIENT_ERRORS = (errors.ServerError, errors.TimedOutError, ConnectionError, TimeoutError)
+
+
+def _enable_wal(session: SQLiteSession, session_name: str) -> None:
+    """Switches a SQLite session database to WAL journaling so many clients don't serialize on fsync."""
+    try:
+        cursor = session._cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+    except sqlite3.Error as e:
+        logger.warning(f"[{session_name}] Could not enable WAL mode for session database: {e}")
+
+
+def _document_location(document) -> types.InputDocumentFileLocation:
+    """Builds the raw file location for a document so it can be passed to download_file."""
+    return types.InputDocumentFileLocation(
+        id=document.id,
+        access_hash=document.access_hash,
+        file_reference=document.file_reference,
+        thumb_size=''
+    )
+
+
+def _preallocate(fd: int, size: int) -> None:
+    """
+    Reserves size bytes for fd before downloading into it, to avoid fragmenting large files.
+    Uses posix_fallocate where available, otherwise extends the file with ftruncate.
+    """
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError: # Filesystem without fallocate support
+            pass
+    os.ftruncate(fd, size)
+
+
+async def _download_range(client: TelegramClient, document, fd: int, start: int, end: int, part_size: int) -> None:
+    """
+    Downloads bytes [start, end) of a document and writes them into fd at their absolute offsets.
+    FloodWaitError is not slept on here: the caller holds a shared download slot, so it propagates
+    to _with_retry, which waits after the slot has been released.
+    """
+    pos = start
+    while pos < end:
+        received = False
+        async for chunk in client.iter_download(
+            document,
+            offset=pos,
+            request_size=part_size,
+            limit=math.ceil((end - pos) / part_size),
+            file_size=document.size
+        ):
+            os.pwrite(fd, chunk, pos)
+            pos += len(chunk)
+            received = True
+        if not received:
+            break # Telegram returned nothing more; don't spin
+
+
+async def parallel_download(
+    client: TelegramClient,
+    document,
+    path: str,
+    workers: int = 4,
+    part_size: int = 512 * 1024
+) -> str:
+    """
+    Downloads a document using several concurrent iter_download streams, each writing its own
+    contiguous range of the output file with os.pwrite. path must be unique to this download
+    (see _reserve_download_path). Returns the path written to.
+    """
+    total = document.size
+    parts_per_worker = math.ceil(math.ceil(total / part_size) / workers)
+    span = parts_per_worker * part_size
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # Reserve the whole file up front so every worker can write at its own offset
+        await asyncio.to_thread(_preallocate, fd, total)
+        async with asyncio.TaskGroup() as tg:
+            for start in range(0, total, span):
+                tg.create_task(_download_range(client, document, fd, start, min(start + span, total), part_size))
+    except BaseException as e_download:
+        os.close(fd)
+        try: os.remove(path)
+        except OSError: pass
+        if isinstance(e_download, BaseExceptionGroup):
+            # Surface a worker's error as-is (flood waits first) so _with_retry can match it like any other
+            flood = e_download.subgroup(errors.FloodWaitError)
+            raise (flood or e_download).exceptions[0] from e_download
+        raise
+    os.close(fd)
+    return path
+
+
+def _reserve_download_path(directory: str, message_id: int, file_name: str) -> str:
+    """
+    Creates an empty, uniquely named file in directory for one download and returns its path,
+    so concurrent saves of files with the same name never write to the same file.
+    """
+    fd, path = tempfile.mkstemp(dir=directory, prefix=f"{message_id}_", suffix=f"_{file_name}")
+    os.close(fd)
+    return path
+
+
+async def _fetch_media(
+    client: TelegramClient,
+    target_message,
+    my_id: int,
+    file_name: str | None,
+    in_memory: bool
+) -> tuple[str | None, io.BytesIO | None]:
+    """
+    Downloads the media of target_message either into memory or under DOWNLOAD_PATH_BASE.
+    Returns (downloaded_file_path, media_buffer); exactly one of them is set.
+    """
+    document = target_message.document
+    downloaded_file_path = None
+    media_buffer = None
+    logger.debug("[%s] Downloading media from message ID %s...", my_id, target_message.id)
+    if in_memory:
+        media_buffer = io.BytesIO()
+        if document:
+            await client.download_file(
+                _document_location(document),
+                file=media_buffer,
+                part_size_kb=512,
+                file_size=document.size,
+                dc_id=document.dc_id
+            )
+        else: # Photos: let Telethon pick the right size/location
+            await client.download_media(target_message.media, file=media_buffer)
+        media_buffer.name = file_name # Telethon uses .name to pick file name and type
+        media_buffer.seek(0)
+        logger.debug("[%s] Media downloaded to memory (%s bytes).", my_id, media_buffer.getbuffer().nbytes)
+    else:
+        user_specific_download_path = os.path.join(DOWNLOAD_PATH_BASE, str(my_id))
+        if my_id not in _dirs_created:
+            await asyncio.to_thread(os.makedirs, user_specific_download_path, exist_ok=True)
+            _dirs_created.add(my_id)
+
+        if document:
+            document_path = await asyncio.to_thread(
+                _reserve_download_path, user_specific_download_path, target_message.id, file_name
+            )
+        if document and hasattr(os, 'pwrite'):
+            downloaded_file_path = await parallel_download(client, document, document_path)
+        elif document:
+            # Single stream, but with 512 KB parts instead of Telethon's small default
+            fd = os.open(document_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                with os.fdopen(fd, 'r+b') as f_document: # Overwrite in place; 'wb' would drop the reservation
+                    await asyncio.to_thread(_preallocate, f_document.fileno(), document.size)
+                    await client.download_file(
+                        _document_location(document),
+                        file=f_document,
+                        part_size_kb=512,
+                        file_size=document.size,
+                        dc_id=document.dc_id
+                    )
+            except BaseException:
+                try: os.remove(document_path)
+                except OSError: pass
+                raise
+            downloaded_file_path = document_path
+        else:
+            downloaded_file_path = await client.download_media(
+                target_message.media,
+                file=user_specific_download_path # Telethon appends original filename
+            )
+        if not downloaded_file_path: # Should not happen if download_media doesn't error
+            raise Exception("Download returned None path, but no error was raised.")
+        logger.debug("[%s] Media downloaded to: %s", my_id, downloaded_file_path)
+    return downloaded_file_path, media_buffer
+
+
+async def _gated_fetch(
+    client: TelegramClient,
+    target_message,
+    my_id: int,
+    file_name: str | None,
+    in_memory: bool
+) -> tuple[str | None, io.BytesIO | None]:
+    """_fetch_media under the shared download semaphore, capping concurrent downloads across all users."""
+    async with _download_sem:
+        return await _fetch_media(client, target_message, my_id, file_name, in_memory)
+
+
+async def _with_retry(coro_fn, my_id: int, action: str, retries: int = RETRY_ATTEMPTS):
+    """
+    Awaits coro_fn() and retries it on flood waits (sleeping the time Telegram asks for) and on
+    transient DC/network errors (exponential back-off). The last failure is re-raised.
+    """
+    for attempt in range(retries):
+        try:
+            return await coro_fn()
+        except errors.FloodWaitError as e_flood:
+            if attempt == retries - 1 or e_flood.seconds > MAX_FLOOD_WAIT_RETRY:
+                raise
+            delay = e_flood.seconds + 1
+            reason = e_flood
+        except TRANSIENT_ERRORS as e_transient:
+            if attempt == retries - 1:
+                raise
+            delay = RETRY_BASE_DELAY * 2 ** attempt
+            reason = e_transient
+        logger.warning("[%s] %s failed (%s), retrying in %ss (attempt %s/%s).", my_id, action, reason, delay, attempt + 1, retries)
+        await asyncio.sleep(delay)
+
+
+async def _send_to_saved_messages(
+    client: TelegramClient,
+    media_buffer: io.BytesIO | None,
+    downloaded_file_path: str | None,
+    caption_text: str,
+    attributes: list | None
+) -> None:
+    """
+    Uploads saved media to the user's "Saved Messages". Files on disk are read through an aiofiles
+    handle, so Telethon's chunked reads happen in a worker thread rather than on the event loop.
+    """
+    if media_buffer is not None:
+        media_buffer.seek(0) # A retried upload must start from the beginning again
+        await client.send_file("me", media_buffer, caption=caption_text, attributes=attributes)
+        return
+    file_size = await asyncio.to_thread(os.path.getsize, downloaded_file_path)
+    async with aiofiles.open(downloaded_file_path, 'rb') as async_file:
+        await client.send_file(
+            "me",
+            async_file, # Telethon awaits read() on file-likes that return awaitables
+            caption=caption_text,
+            attributes=attributes,
+            file_size=file_size # Saves Telethon a seek()/tell() round trip through the thread pool
+        )
+
+
+async def _show_status(event: events.NewMessage.Event, status_msg, text: str, my_id: int):
+    """Edits the status message if there is one, otherwise replies to the trigger. Returns the message shown."""
+    try:
+        if status_msg:
+            return await status_msg.edit(text)
+        return await event.reply(text)
+    except Exception as e_status:
+        logger.warning("[%s] Could not show status '%s' in chat %s: %s", my_id, text, event.chat_id, e_status)
+        return None
+
+
+async def _react(client: TelegramClient, event: events.NewMessage.Event, emoticon: str, my_id: int) -> None:
+    """Reacts to the trigger message; a single cheap RPC instead of a status message round-trip."""
+    try:
+        await client(functions.messages.SendReactionRequest(
+            peer=event.input_chat,
+            msg_id=event.id,
+            reaction=[types.ReactionEmoji(emoticon=emoticon)]
+        ))
+    except Exception as e_react: # Reactions can be disabled in a chat; the save itself still succeeded
+        logger.warning("[%s] Could not react to message %s in chat %s: %s", my_id, event.id, event.chat_id, e_react)
+
+
+async def _delayed_delete(message, delay: float) -> None:
+    """Deletes a status message after delay seconds."""
+    await asyncio.sleep(delay)
+    try: await message.delete()
+    except Exception: pass # Ignore if already deleted
+
+
+def _schedule_delete(message, delay: float) -> None:
+    """Runs _delayed_delete in the background so the handler can return right away."""
+    task = asyncio.create_task(_delayed_delete(message, delay))
+    _cleanup_tasks.add(task)
+    task.add_done_callback(_cleanup_tasks.discard)
+
+
+async def _handle_save(event: events.NewMessage.Event, client: TelegramClient, my_id: int) -> None:
+    """
+    Handles a trigger reply: downloads the replied-to media and sends it to the user's "Saved Messages".
+    Shared by every user instance; run_user_instance binds client and my_id with functools.partial.
+    """
+    replied_to_msg_id = event.reply_to_msg_id
+    chat_id = event.chat_id
+    status_msg = None # Only created for media big enough to take a while
+
+    target_message = None
+    try:
+        target_message = await event.get_reply_message() # Reuses the cached reply when Telethon has it
+    except Exception as e_get_msg:
+         logger.error("[%s] Failed to get replied message %s in chat %s: %s", my_id, replied_to_msg_id, chat_id, e_get_msg)
+         await _show_status(event, None, "❌ Error: Could not fetch the replied message.", my_id)
+         return
+
+
+    if not target_message:
+        err_text = "❌ Error: Could not fetch the replied message (it might have been deleted)."
+        await _show_status(event, None, err_text, my_id)
+        return
+
+    if not target_message.media:
+        err_text = "ℹ️ The replied message does not contain media."
+        status_msg = await _show_status(event, None, err_text, my_id)
+        if status_msg:
+            _schedule_delete(status_msg, 5)
+        return
+
+    # Use the sender Telethon already attached to the message; only resolve it if missing
+    media_sender = target_message.sender
+    if media_sender is None and target_message.sender_id:
+        try:
+            media_sender = await client.get_entity(target_message.sender_id)
+        except Exception as e_sender:
+            logger.warning("[%s] Could not resolve sender %s: %s", my_id, target_message.sender_id, e_sender)
+    sssender_info = "Unknown User"
+    if media_sender:
+        # Channels have a title instead of first/last names
+        name_parts = (
+            getattr(media_sender, 'first_name', None) or getattr(media_sender, 'title', None),
+            getattr(media_sender, 'last_name', None),
+            f"(ID: {media_sender.id})"
+        )
+        sssender_info = " ".join(part for part in name_parts if part)
+
+    document = target_message.document
+    media_file = target_message.file # None for media without a file (polls, locations, ...)
+    file_name = None
+    if media_file:
+        file_name = os.path.basename(media_file.name or f"{target_message.id}{media_file.ext or ''}")
+    # Small media never touches the disk: download into memory and upload straight from the buffer
+    in_memory = bool(media_file and media_file.size is not None and media_file.size <= IN_MEMORY_MAX_SIZE)
+    # Quick saves skip the status message entirely and just get a reaction when done
+    quick_save = bool(media_file and media_file.size is not None and media_file.size <= QUICK_SAVE_MAX_SIZE)
+    if not quick_save:
+        try:
+            # Reply to the command message itself for status updates
+            status_msg = await event.reply("⏳ Processing...")
+        except Exception as e_status:
+            logger.warning("[%s] Could not send status message in chat %s: %s", my_id, chat_id, e_status)
+
+    downloaded_file_path = None
+    media_buffer = None
+    try:
+        # Only the fetch itself holds a download slot; retry back-off sleeps happen outside it
+        downloaded_file_path, media_buffer = await _with_retry(
+            lambda: _gated_fetch(client, target_message, my_id, file_name, in_memory),
+            my_id, "Download"
+        )
+    except Exception as err:
+        error_msg = f"❌ Failed to download file: {err}"
+        logger.error("[%s] Download error: %s", my_id, err, exc_info=True)
+        await _show_status(event, status_msg, error_msg, my_id)
+        return
+
+    if in_memory or downloaded_file_path: # _fetch_media raises rather than returning no file, so no stat is needed
+        file_name_only = file_name or os.path.basename(downloaded_file_path) # On-disk names carry a unique prefix/suffix
+        caption_text = (f"✅ Saved: {file_name_only}\n"
+                        f"👤 Originally from: {sssender_info}\n"
+                        f"💬 Replied in chat: {event.chat.title if hasattr(event.chat, 'title') and event.chat.title else 'DM/Unknown Chat'}")
+        try:
+            await _with_retry(
+                lambda: _send_to_saved_messages(
+                    client, media_buffer, downloaded_file_path, caption_text,
+                    document.attributes if document else None # Keep video/audio metadata
+                ),
+                my_id, "Upload"
+            )
+            success_text = "✅ Media saved to your Saved Messages!"
+            logger.info("[%s] Saved message %s from chat %s to Saved Messages.", my_id, target_message.id, chat_id)
+            if status_msg: await status_msg.edit(success_text)
+            else: await _react(client, event, SUCCESS_REACTION, my_id)
+
+            # Optionally, delete the status message after a delay
+            if status_msg:
+                _schedule_delete(status_msg, 10)
+        except Exception as send_err:
+            error_msg = f"❌ Failed to send file to Saved Messages: {send_err}"
+            logger.error("[%s] Send error: %s", my_id, send_err, exc_info=True)
+            await _show_status(event, status_msg, error_msg, my_id)
+        finally:
+            # Clean up the downloaded file from server (in-memory saves have nothing on disk)
+            if downloaded_file_path:
+                try:
+                    await asyncio.to_thread(os.remove, downloaded_file_path)
+                    logger.debug("[%s] Cleaned up temporary file: %s", my_id, downloaded_file_path)
+                except OSError as e_os:
+                    logger.error("[%s] Error removing temp file %s: %s", my_id, downloaded_file_path, e_os)
+    else:
+        error_msg = "❌ File not found after download, or download failed silently."
+        logger.error("[%s] %s", my_id, error_msg)
+        await _show_status(event, status_msg, error_msg, my_id)
+
+
+async def _monitor(client: TelegramClient, session_name: str) -> None:
+    """Keeps a logged-in client running until it disconnects or the task is cancelled (e.g. on logout)."""
+    try:
+        await client.run_until_disconnected()
+    except asyncio.CancelledError:
+        logger.info(f"[{session_name}] Monitoring cancelled.")
+        raise
+    except Exception as e: # Never let one user's failure propagate into the shared task group
+        logger.error(f"[{session_name}] Monitoring stopped with an error: {e}")
+    finally:
+        if monitoring_tasks.get(session_name) is asyncio.current_task():
+            monitoring_tasks.pop(session_name, None)
+        if client.is_connected(): await client.disconnect()
 
 
 async def run_user_instance(
@@ -17,20 +470,19 @@ async def run_user_instance(
     command_trigger: str,
     phone_to_login: str,
     get_code_callback: callable, # async def func() -> str | None
-    get_password_callback: callable # async def func() -> str | None
+    get_password_callback: callable, # async def func() -> str | None
+    task_group: asyncio.TaskGroup, # Owned by the manager; runs the long-lived monitoring task
+    code_sent_event: asyncio.Event | None = None # Set once the login code has been requested
 ) -> int | None: # Returns Telethon user ID on success, None on failure
     """
     Runs a Telethon client instance for a specific user, handling login via bot callbacks.
     Returns the user's Telegram ID if login is successful and monitoring starts, None otherwise.
+    The monitoring task is started in task_group and registered in monitoring_tasks[session_name].
     """
-    # Ensure necessary directories exist
-    if not os.path.exists('sessions'):
-        os.makedirs('sessions')
-    if not os.path.exists(DOWNLOAD_PATH_BASE):
-        os.makedirs(DOWNLOAD_PATH_BASE)
-
     client_session_path = os.path.join('sessions', session_name)
-    client = TelegramClient(client_session_path, api_id, api_hash)
+    # Raise every flood wait instead of letting Telethon sleep through short ones: a download would
+    # otherwise sleep while holding a _download_sem slot. _with_retry waits outside the slot.
+    client = TelegramClient(client_session_path, api_id, api_hash, flood_sleep_threshold=0)
 
     logger.info(f"[{session_name}] Attempting to connect for {phone_to_login}...")
 
@@ -38,12 +490,15 @@ async def run_user_instance(
         if not await client.connect():
             logger.error(f"[{session_name}] Failed to connect to Telegram infrastructure.")
             return None
+        if isinstance(client.session, SQLiteSession):
+            _enable_wal(client.session, session_name)
 
         me = None # Initialize 'me' to store user entity
         if not await client.is_user_authorized():
             logger.info(f"[{session_name}] User not authorized. Initiating login for {phone_to_login}.")
             try:
                 await client.send_code_request(phone_to_login)
+                if code_sent_event: code_sent_event.set() # Let the bot prompt the user for the code
                 logger.info(f"[{session_name}] Code request sent. Awaiting code via bot callback for {phone_to_login}.")
                 user_code = await get_code_callback() # This callback is provided by manager_and_bot.py
                 if user_code is None:
@@ -70,6 +525,10 @@ async def run_user_instance(
                     logger.error(f"[{session_name}] Invalid 2FA password provided for {phone_to_login}.")
                     await client.disconnect()
                     raise # Re-raise to be caught by manager_and_bot.py for specific user message
+                except (errors.FloodWaitError, OSError) as e_pw_transient:
+                    logger.error(f"[{session_name}] Sign-in with 2FA password for {phone_to_login} failed: {e_pw_transient}")
+                    await client.disconnect()
+                    raise # Reported to the user by manager_and_bot.py
                 except Exception as e_pw_signin:
                     logger.error(f"[{session_name}] Sign-in with 2FA password for {phone_to_login} failed: {e_pw_signin}")
                     await client.disconnect()
@@ -83,144 +542,51 @@ async def run_user_instance(
                 logger.error(f"[{session_name}] Invalid phone number: {phone_to_login}.")
                 await client.disconnect()
                 raise # Re-raise
+            except (errors.FloodWaitError, OSError) as e_login_transient: # Rate limits and connection problems
+                logger.error(f"[{session_name}] Login process for {phone_to_login} failed: {e_login_transient}")
+                await client.disconnect()
+                raise # Reported to the user by manager_and_bot.py
             except Exception as e_login: # Catch other potential login errors
                 logger.error(f"[{session_name}] Login process for {phone_to_login} encountered an error: {e_login}")
                 await client.disconnect()
                 return None
         else: # Already authorized from a previous session file
             logger.info(f"[{session_name}] User already authorized for {phone_to_login} (session file exists).")
-            me = await client.get_me()
-
+            me = await client.get_me() # Returns None (rather than raising) if the stored session was revoked
 
-        if not await client.is_user_authorized() or not me:
+        # sign_in() and get_me() only return a user once authorized, so no extra is_user_authorized() round-trip
+        if not me:
             logger.error(f"[{session_name}] Still not authorized for {phone_to_login} after login attempt or failed to get 'me'.")
             if client.is_connected(): await client.disconnect()
             return None
 
-        # Save the session to file now that we are authorized
-        with open(client_session_path, 'w') as f_session:
-            f_session.write(client.session.save())
-        logger.info(f"[{session_name}] Session for {phone_to_login} (User ID: {me.id}) saved to file: {client_session_path}")
+        # The SQLite session at client_session_path + '.session' is persisted incrementally by Telethon
+        logger.info(f"[{session_name}] Session for {phone_to_login} (User ID: {me.id}) stored in {client_session_path}.session")
 
         my_id = me.id # Get the ID of the logged-in Telethon user
         logger.info(f"[{session_name}] Login successful. Running for: {me.username or me.first_name} (ID: {my_id}). Trigger: '{command_trigger}'")
 
-        @client.on(events.NewMessage(outgoing=True))
-        async def handle_outgoing_reply(event: events.NewMessage.Event):
-            if event.is_reply and event.raw_text == command_trigger:
-                # Ensure this event is from the correct user for this client instance
-                if event.sender_id != my_id:
-                    logger.warning(f"[{my_id}] Outgoing message from unexpected sender_id {event.sender_id}. Ignoring.")
-                    return
-
-                replied_to_msg_id = event.reply_to_msg_id
-                chat_id = event.chat_id
-                status_msg = None
-                try:
-                    # Reply to the command message itself for status updates
-                    status_msg = await event.reply("⏳ Processing...")
-                except Exception as e_status:
-                    logger.warning(f"[{my_id}] Could not send status message in chat {chat_id}: {e_status}")
-
-                target_message = None
-                try:
-                    target_message = await client.get_messages(chat_id, ids=replied_to_msg_id)
-                except Exception as e_get_msg:
-                     logger.error(f"[{my_id}] Failed to get replied message {replied_to_msg_id} in chat {chat_id}: {e_get_msg}")
-                     if status_msg: await status_msg.edit("❌ Error: Could not fetch the replied message.")
-                     return
-
-
-                if not target_message:
-                    err_text = "❌ Error: Could not fetch the replied message (it might have been deleted)."
-                    if status_msg: await status_msg.edit(err_text)
-                    else: logger.info(f"[{my_id}] {err_text}")
-                    return
-
-                if not target_message.media:
-                    err_text = "ℹ️ The replied message does not contain media."
-                    if status_msg: await status_msg.edit(err_text)
-                    else: logger.info(f"[{my_id}] {err_text}")
-                    if status_msg:
-                        await asyncio.sleep(5)
-                        try: await status_msg.delete()
-                        except Exception: pass # Ignore if already deleted
-                    return
-                
-                media_sender = await target_message.get_sender()
-                sssender_info = "Unknown User"
-                if media_sender:
-                    sssender_info = f"{media_sender.first_name or ''}"
-                    if media_sender.last_name: sssender_info += f" {media_sender.last_name}"
-                    sssender_info += f" (ID: {media_sender.id})"
-                
-                user_specific_download_path = os.path.join(DOWNLOAD_PATH_BASE, str(my_id))
-                if not os.path.exists(user_specific_download_path):
-                    os.makedirs(user_specific_download_path)
-
-                downloaded_file_path = None
-                try:
-                    logger.info(f"[{my_id}] Downloading media from message ID {target_message.id}...")
-                    downloaded_file_path = await client.download_media(
-                        target_message.media,
-                        file=user_specific_download_path # Telethon appends original filename
-                    )
-                    if not downloaded_file_path: # Should not happen if download_media doesn't error
-                        raise Exception("Download returned None path, but no error was raised.")
-                    logger.info(f"[{my_id}] Media downloaded to: {downloaded_file_path}")
-                except Exception as err:
-                    error_msg = f"❌ Failed to download file: {err}"
-                    logger.error(f"[{my_id}] Download error: {err}", exc_info=True)
-                    if status_msg: await status_msg.edit(error_msg)
-                    return
-
-                if downloaded_file_path and os.path.exists(downloaded_file_path):
-                    file_name_only = os.path.basename(downloaded_file_path)
-                    caption_text = (f"✅ Saved: {file_name_only}\n"
-                                    f"👤 Originally from: {sssender_info}\n"
-                                    f"💬 Replied in chat: {event.chat.title if hasattr(event.chat, 'title') and event.chat.title else 'DM/Unknown Chat'}")
-                    try:
-                        await client.send_file(
-                            "me", # Send to User's "Saved Messages"
-                            downloaded_file_path,
-                            caption=caption_text
-                        )
-                        success_text = "✅ Media saved to your Saved Messages!"
-                        if status_msg: await status_msg.edit(success_text)
-                        else: logger.info(f"[{my_id}] {success_text}")
-                        
-                        # Optionally, delete the status message after a delay
-                        if status_msg:
-                            await asyncio.sleep(10)
-                            try: await status_msg.delete()
-                            except Exception: pass
-                    except Exception as send_err:
-                        error_msg = f"❌ Failed to send file to Saved Messages: {send_err}"
-                        logger.error(f"[{my_id}] Send error: {send_err}", exc_info=True)
-                        if status_msg: await status_msg.edit(error_msg)
-                    finally:
-                        # Clean up the downloaded file from server
-                        try:
-                            os.remove(downloaded_file_path)
-                            logger.info(f"[{my_id}] Cleaned up temporary file: {downloaded_file_path}")
-                        except OSError as e_os:
-                            logger.error(f"[{my_id}] Error removing temp file {downloaded_file_path}: {e_os}")
-                else:
-                    error_msg = "❌ File not found after download, or download failed silently."
-                    logger.error(f"[{my_id}] {error_msg}")
-                    if status_msg: await status_msg.edit(error_msg)
+        # Telethon applies the pattern and reply check before dispatching, so ordinary outgoing messages
+        # never wake the handler. outgoing=True already guarantees the sender is this account.
+        client.add_event_handler(
+            functools.partial(_handle_save, client=client, my_id=my_id),
+            events.NewMessage(
+                outgoing=True,
+                pattern=re.escape(command_trigger) + r'\Z',
+                func=lambda e: e.is_reply
+            )
+        )
 
         logger.info(f"[{session_name}] Event handler set for user {my_id}. Monitoring started.")
-        # Create a separate task for run_until_disconnected so this function can return the user ID
-        # The calling function (manager_and_bot) will store this task if it needs to cancel it later.
-        monitoring_task = asyncio.create_task(client.run_until_disconnected())
-        # Store the monitoring task in a way that manager_and_bot.py can access it for logout
-        # This is a bit tricky. For now, we rely on the manager to handle its own task for `run_user_instance`.
-        # The `monitoring_task` here is local. If manager cancels `run_user_instance` task, this also goes.
+        # Run the client in the manager's task group so this function can return the user ID
+        monitoring_tasks[session_name] = task_group.create_task(
+            _monitor(client, session_name), name=f"monitor-{my_id}"
+        )
         
         return my_id # Return the Telethon user's ID on successful setup and monitoring start
 
-    except (errors.PhoneCodeInvalidError, errors.PhoneNumberInvalidError, errors.PasswordHashInvalidError) as e_login_specific:
+    except (errors.PhoneCodeInvalidError, errors.PhoneNumberInvalidError, errors.PasswordHashInvalidError,
+            errors.FloodWaitError, OSError) as e_login_specific: # Expected failures: no traceback needed
         logger.error(f"[{session_name}] Specific login error for {phone_to_login}: {e_login_specific}")
         if client.is_connected(): await client.disconnect()
         raise # Re-raise for manager_and_bot to catch and inform user specifically